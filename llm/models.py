@@ -368,11 +368,14 @@ class Prompt:
         tools=None,
         tool_results=None,
     ):
-        self._prompt = prompt
+        from llm.sanitize import sanitize_unicode
+
+        # Sanitize once here rather than on every .prompt/.system access
+        self._prompt = sanitize_unicode(prompt)
         self.model = model
         self.attachments = list(attachments or [])
         self.fragments = fragments or []
-        self._system = system
+        self._system = sanitize_unicode(system)
         self.system_fragments = system_fragments or []
         self.prompt_json = prompt_json
         if schema and not isinstance(schema, dict) and issubclass(schema, BaseModel):
@@ -384,21 +387,27 @@ class Prompt:
 
     @property
     def prompt(self):
-        from llm.sanitize import sanitize_unicode
-
-        raw = "\n".join(self.fragments + ([self._prompt] if self._prompt else []))
-        return sanitize_unicode(raw)
+        # _prompt was sanitized in __init__, fragments lists can still be changed
+        return "\n".join(
+            [_sanitize_bit(bit) for bit in self.fragments]
+            + ([self._prompt] if self._prompt else [])
+        )
 
     @property
     def system(self):
-        from llm.sanitize import sanitize_unicode
+        bits = [_sanitize_bit(bit).strip() for bit in self.system_fragments]
+        bits.append((self._system or "").strip())
+        return "\n\n".join(bit for bit in bits if bit)
 
-        bits = [
-            bit.strip()
-            for bit in (self.system_fragments + [self._system or ""])
-            if bit.strip()
-        ]
-        return sanitize_unicode("\n\n".join(bits))
+
+def _sanitize_bit(bit: Union[str, Fragment]) -> str:
+    # Fragments are sanitized when they are created, so there is no need to
+    # scan their (often large) content again on every property access
+    if isinstance(bit, Fragment):
+        return bit
+    from llm.sanitize import sanitize_unicode
+
+    return sanitize_unicode(bit)
 
 
 def _wrap_tools(tools: List[ToolDef]) -> List[Tool]:
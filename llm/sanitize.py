@@ -10,7 +10,10 @@ Reference: https://embracethered.com/blog/posts/2024/m365-copilot-prompt-injecti
 
 from __future__ import annotations
 
+import functools
 import os
+import re
+import sys
 from typing import Any, overload
 
 # Unicode Tag characters (U+E0000-U+E007F) - the PRIMARY attack vector for ASCII smuggling
@@ -48,8 +51,65 @@ _BIDI = frozenset({
 # Strict mode includes zero-width and BiDi (may break legitimate text)
 _STRICT_REMOVE = _ALWAYS_REMOVE | _ZERO_WIDTH | _BIDI
 
-# Cache strict mode setting at module load (checked once, not on every call)
-_STRICT_MODE_ENV = os.environ.get("LLM_SANITIZE_STRICT", "").lower() in ("1", "true", "yes")
+
+def _ranges(codepoints: frozenset[int]) -> list[tuple[int, int]]:
+    """Collapse a set of code points into sorted, inclusive (low, high) runs."""
+    runs: list[tuple[int, int]] = []
+    for cp in sorted(codepoints):
+        if runs and cp == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], cp)
+        else:
+            runs.append((cp, cp))
+    return runs
+
+
+# The sets above collapse to a handful of contiguous runs (a single one in
+# default mode), so matching is a few range compares per character
+_DEFAULT_RANGES = _ranges(_ALWAYS_REMOVE)
+_STRICT_RANGES = _ranges(_STRICT_REMOVE)
+
+
+def _compile(ranges: list[tuple[int, int]]) -> re.Pattern[str]:
+    return re.compile(
+        "[" + "".join(f"\\U{low:08X}-\\U{high:08X}" for low, high in ranges) + "]"
+    )
+
+
+# Strings up to this length have their result cached - short values such as
+# dict keys, tool names and enum values repeat a lot across tool results
+_CACHE_MAX_LENGTH = 256
+
+# Short strings are checked for removable characters in batches of up to about
+# this many characters, bounding the memory used by the joined copy
+_BATCH_MAX_CHARS = 65536
+
+# Strings longer than this are filtered with NumPy, but only when something
+# else has already imported it - it is never imported just for sanitization
+_NUMPY_THRESHOLD = 4096
+
+
+@functools.cache
+def _pattern(strict: bool) -> re.Pattern[str]:
+    """
+    Pattern matching the characters removed in strict or default mode.
+
+    Compiled on first use rather than at import, so CLI commands that never
+    sanitize anything don't pay for it. re.sub() scans in C and returns the
+    input string object itself when nothing matches, so clean text (the
+    overwhelmingly common case) costs a single scan and no allocation.
+    """
+    return _compile(_STRICT_RANGES if strict else _DEFAULT_RANGES)
+
+
+@functools.cache
+def _active_pattern() -> re.Pattern[str]:
+    """
+    Pattern used when strict=False: the strict one if LLM_SANITIZE_STRICT is set.
+
+    The environment is checked on first use, then cached for every later call.
+    """
+    strict = os.environ.get("LLM_SANITIZE_STRICT", "").lower() in ("1", "true", "yes")
+    return _pattern(strict)
 
 
 @overload
@@ -72,7 +132,7 @@ def sanitize_unicode(text: Any, strict: bool = False) -> Any:
     WARNING: Strict mode breaks compound emojis and RTL text rendering.
 
     The mode can also be controlled via LLM_SANITIZE_STRICT=1 environment variable
-    (checked once at module load for performance).
+    (checked once, on first use, for performance).
 
     Args:
         text: Input string to sanitize. None and non-strings pass through unchanged.
@@ -89,15 +149,139 @@ def sanitize_unicode(text: Any, strict: bool = False) -> Any:
     if not isinstance(text, str):
         return text
 
-    if not text:
+    # CPython records whether a string is pure ASCII when it is created, so this
+    # check is O(1) - and none of the characters we remove are ASCII
+    if text.isascii():
+        return text
+
+    pattern = _pattern(True) if strict else _active_pattern()
+
+    # Only exact str goes through the cache: it compares keys by equality, so a
+    # subclass with its own __eq__ could hand its result to a different string
+    if type(text) is str and len(text) <= _CACHE_MAX_LENGTH:
+        cleaned = _sanitize_short(text, pattern)
+        # Return the caller's own object for clean text, not an equal cached one
+        return text if cleaned is None else cleaned
+
+    # LLM_SANITIZE_STRICT may have selected strict mode without strict=True
+    strict = pattern is _pattern(True)
+
+    if len(text) > _NUMPY_THRESHOLD:
+        # Only use NumPy if something else already imported it - importing it
+        # here would cost more CLI startup time than the vectorized scan saves
+        np = sys.modules.get("numpy")
+        if np is not None:
+            return _sanitize_numpy(np, text, strict)
+
+    # Every tag character is encoded in UTF-8 as F3 A0 8x xx. Encoding and then
+    # searching the bytes with memmem() is faster than the regex scan, so use it
+    # to reject clean text in default mode. Other characters can share that
+    # prefix (e.g. U+E0100 variation selectors), so a hit still goes to the regex
+    if not strict:
+        encoded = text.encode("utf-8", "surrogatepass")
+        if b"\xf3\xa0" not in encoded:
+            return text
+
+    cleaned = pattern.sub("", text)
+    # Decide by length, not identity: for str subclasses sub() returns a new
+    # plain str even when nothing matched, and the caller's object should be kept
+    return text if len(cleaned) == len(text) else cleaned
+
+
+@functools.lru_cache(maxsize=4096)
+def _sanitize_short(text: str, pattern: re.Pattern[str]) -> str | None:
+    """Sanitized text, or None if nothing needed removing."""
+    cleaned = pattern.sub("", text)
+    # Removal only ever shortens text, so comparing lengths tells clean text apart
+    return None if len(cleaned) == len(text) else cleaned
+
+
+def _sanitize_numpy(np: Any, text: str, strict: bool) -> str:
+    """Vectorized equivalent of the regex path, for very long strings."""
+    # "<u4" pins the byte order to match the -le encoding; a native np.uint32
+    # would byte-swap every code point on big-endian hosts and match nothing
+    codes = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype="<u4")
+    mask = np.zeros(len(codes), dtype=bool)
+    for low, high in _STRICT_RANGES if strict else _DEFAULT_RANGES:
+        mask |= (codes >= low) & (codes <= high)
+    if not mask.any():
         return text
+    return codes[~mask].tobytes().decode("utf-32-le", "surrogatepass")
 
-    # Use cached env var check for performance
-    if _STRICT_MODE_ENV:
-        strict = True
 
-    chars_to_remove = _STRICT_REMOVE if strict else _ALWAYS_REMOVE
-    return "".join(c for c in text if ord(c) not in chars_to_remove)
+# Node kinds for walking nested structures. Values parsed from JSON are always
+# these exact types, so one type() lookup replaces a chain of isinstance() calls;
+# _slow_kind() handles subclasses and anything else
+_LEAF, _STR, _DICT, _SEQUENCE = range(4)
+_KINDS = {
+    str: _STR,
+    dict: _DICT,
+    list: _SEQUENCE,
+    tuple: _SEQUENCE,
+    int: _LEAF,
+    float: _LEAF,
+    bool: _LEAF,
+    type(None): _LEAF,
+}
+
+
+def _slow_kind(obj: Any) -> int:
+    if isinstance(obj, str):
+        return _STR
+    elif isinstance(obj, dict):
+        return _DICT
+    elif isinstance(obj, (list, tuple)):
+        return _SEQUENCE
+    return _LEAF
+
+
+def _has_dirty(obj: Any, pattern: re.Pattern[str]) -> bool:
+    """Return True if any string (or key) in obj matches pattern."""
+    # Walk with an explicit stack rather than recursion so deeply nested tool
+    # output can't hit RecursionError and leaves don't each cost a call.
+    # Containers already visited are skipped, so self-referencing input
+    # terminates instead of looping forever.
+    strings: list[str] = []
+    batched = 0
+    seen: set[int] = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        kind = _KINDS.get(type(item))
+        if kind is None:
+            kind = _slow_kind(item)
+        if kind == _STR:
+            # ASCII strings can't match, and isascii() is O(1) - leaving them
+            # out keeps the join below from copying (and widening) all of them
+            if item.isascii():
+                continue
+            if len(item) > _CACHE_MAX_LENGTH:
+                # Long strings gain nothing from batching and would only make
+                # the join copy them, so search each one on its own
+                if pattern.search(item) is not None:
+                    return True
+                continue
+            strings.append(item)
+            batched += len(item)
+            if batched > _BATCH_MAX_CHARS:
+                if pattern.search("".join(strings)) is not None:
+                    return True
+                strings.clear()
+                batched = 0
+        elif kind == _DICT or kind == _SEQUENCE:
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            if kind == _DICT:
+                stack.extend(item.keys())
+                stack.extend(item.values())
+            else:
+                stack.extend(item)
+    # Short non-ASCII strings are checked in batches: pattern only matches
+    # single characters, so joining can't create or hide a match, and one
+    # C-level scan of the joined text is much cheaper than a Python-level call
+    # per string. The batch is flushed above once it reaches _BATCH_MAX_CHARS
+    return bool(strings) and pattern.search("".join(strings)) is not None
 
 
 def sanitize_dict(obj: Any) -> Any:
@@ -108,14 +292,52 @@ def sanitize_dict(obj: Any) -> Any:
         obj: Any object - strings are sanitized, dicts/lists/tuples are recursed into
 
     Returns:
-        Sanitized copy of the structure with all strings cleaned
+        Sanitized copy of the structure with all strings cleaned, or obj
+        itself if it contains nothing that needs removing
     """
-    if isinstance(obj, str):
+    if not _has_dirty(obj, _active_pattern()):
+        return obj
+    return _sanitize_nested(obj)
+
+
+def _sanitize_nested(obj: Any, parents: dict[int, bool] | None = None) -> Any:
+    # Containers are only rebuilt when something inside them changed, relying on
+    # sanitize_unicode() returning clean strings as the same object. This slow
+    # path recurses, so dirty input nested deeper than the recursion limit still
+    # raises RecursionError. parents maps the ids of the containers enclosing
+    # obj to whether they were reached again from inside themselves. Such a
+    # container is returned as-is where it recurs, which is only correct if it
+    # ends up unchanged - so clean cycles are kept, while a container that
+    # contains itself and needs rebuilding raises ValueError.
+    kind = _KINDS.get(type(obj))
+    if kind is None:
+        kind = _slow_kind(obj)
+    if kind == _STR:
         return sanitize_unicode(obj)
-    elif isinstance(obj, dict):
-        return {sanitize_dict(k): sanitize_dict(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [sanitize_dict(item) for item in obj]
-    elif isinstance(obj, tuple):
-        return tuple(sanitize_dict(item) for item in obj)
-    return obj
+    elif kind == _LEAF:
+        return obj
+    if parents is None:
+        parents = {}
+    elif id(obj) in parents:
+        parents[id(obj)] = True
+        return obj
+    parents[id(obj)] = False
+    if kind == _DICT:
+        out = {}
+        changed = False
+        for k, v in obj.items():
+            new_k = _sanitize_nested(k, parents)
+            new_v = _sanitize_nested(v, parents)
+            if new_k is not k or new_v is not v:
+                changed = True
+            out[new_k] = new_v
+        result = out if changed else obj
+    else:
+        items = [_sanitize_nested(item, parents) for item in obj]
+        if all(new is old for new, old in zip(items, obj)):
+            result = obj
+        else:
+            result = items if isinstance(obj, list) else tuple(items)
+    if parents.pop(id(obj)) and result is not obj:
+        raise ValueError("Cannot sanitize a structure that contains itself")
+    return result
@@ -3,6 +3,7 @@ Tests for llm.sanitize module - ASCII smuggling prevention.
 """
 
 import os
+import sys
 import pytest
 from llm.sanitize import sanitize_unicode
 
@@ -92,6 +93,57 @@ class TestSanitizeUnicodeDefault:
         """None should return None (falsy passthrough)."""
         assert sanitize_unicode(None) is None
 
+    def test_clean_text_returned_unchanged(self):
+        """Text with nothing to remove should be returned as the same object."""
+        text = "Héllo Wörld 你好 👨‍👩‍👧 " * 10
+        assert sanitize_unicode(text) is text
+
+    def test_repeated_short_text(self):
+        """Cached results for short text should still return the caller's object."""
+        first = "".join(["Zürich", "\U000E0041"])
+        second = "".join(["Zürich", "\U000E0041"])
+        assert sanitize_unicode(first) == sanitize_unicode(second) == "Zürich"
+        clean_first = "".join(["Zür", "ich"])
+        clean_second = "".join(["Zür", "ich"])
+        assert sanitize_unicode(clean_first) is clean_first
+        assert sanitize_unicode(clean_second) is clean_second
+
+    def test_str_subclass_does_not_poison_cache(self):
+        """A clean str subclass should not make equal plain strings lose identity."""
+
+        class Name(str):
+            pass
+
+        for length in (1, 100):
+            first = Name("Zürich" * length)
+            assert sanitize_unicode(first) is first
+            assert sanitize_unicode(first, strict=True) is first
+            plain = "".join(["Zür", "ich"]) * length
+            assert sanitize_unicode(plain) is plain
+            assert sanitize_unicode(plain, strict=True) is plain
+
+    def test_str_subclass_with_custom_equality_is_not_cached(self):
+        """A subclass equal to a different string must not share its cached result."""
+
+        class CaseInsensitive(str):
+            def __eq__(self, other):
+                return self.casefold() == str(other).casefold()
+
+            def __hash__(self):
+                return hash(self.casefold())
+
+        assert sanitize_unicode(CaseInsensitive("Ä\U000E0041")) == "Ä"
+        assert sanitize_unicode("ä\U000E0041") == "ä"
+
+    def test_longer_text(self):
+        """Text too long to be cached should be sanitized the same way."""
+        clean = "Héllo 你好 👨‍👩‍👧 " * 50
+        assert sanitize_unicode(clean) is clean
+        # U+E0100 (a variation selector) shares its UTF-8 prefix with tags
+        variation = "葛\U000E0100 " * 100
+        assert sanitize_unicode(variation) == variation
+        assert sanitize_unicode(clean + "\U000E0041" + variation) == clean + variation
+
 
 class TestSanitizeUnicodeStrict:
     """Tests for sanitize_unicode in strict mode.
@@ -138,11 +190,24 @@ class TestSanitizeUnicodeStrict:
         assert "\u200D" not in result
         assert result != family
 
+    def test_strict_matches_exactly_the_removal_set(self):
+        """Strict mode should remove every listed code point and nothing adjacent."""
+        from llm.sanitize import _STRICT_REMOVE
+
+        neighbours = {cp + offset for cp in _STRICT_REMOVE for offset in (-1, 1)}
+        for cp in _STRICT_REMOVE | neighbours:
+            expected = "" if cp in _STRICT_REMOVE else chr(cp)
+            assert sanitize_unicode(chr(cp), strict=True) == expected
+
     def test_strict_env_var(self):
         """LLM_SANITIZE_STRICT=1 should enable strict mode."""
+        from llm.sanitize import _active_pattern
+
         original = os.environ.get("LLM_SANITIZE_STRICT")
         try:
             os.environ["LLM_SANITIZE_STRICT"] = "1"
+            # The setting is read once and cached, so discard the cached value
+            _active_pattern.cache_clear()
             text = "Hello\u200BWorld"
             assert sanitize_unicode(text) == "HelloWorld"
         finally:
@@ -150,6 +215,74 @@ class TestSanitizeUnicodeStrict:
                 os.environ.pop("LLM_SANITIZE_STRICT", None)
             else:
                 os.environ["LLM_SANITIZE_STRICT"] = original
+            _active_pattern.cache_clear()
+
+
+class TestSanitizeUnicodeNumpy:
+    """Long strings are filtered with NumPy when it has already been imported."""
+
+    @pytest.mark.parametrize("strict", (False, True))
+    def test_numpy_path_matches_regex_path(self, strict):
+        pytest.importorskip("numpy")
+        from llm import sanitize
+
+        text = "Héllo\U000E0041 שלום\u202E\u200B 👨‍💻 " * 1000
+        assert len(text) > sanitize._NUMPY_THRESHOLD
+        pattern = sanitize._pattern(strict)
+        assert sanitize_unicode(text, strict=strict) == pattern.sub("", text)
+
+    def test_numpy_path_does_not_depend_on_native_byte_order(self):
+        """Code points must be read little-endian whatever the host's byte order."""
+        np = pytest.importorskip("numpy")
+        from llm.sanitize import _sanitize_numpy
+
+        dtypes = []
+
+        class BigEndianNumpy:
+            """NumPy as seen on a big-endian host, where native uint32 is ">u4"."""
+
+            uint32 = np.dtype(">u4")
+
+            def __getattr__(self, name):
+                return getattr(np, name)
+
+            def frombuffer(self, buffer, dtype):
+                dtypes.append(np.dtype(dtype))
+                return np.frombuffer(buffer, dtype=dtype)
+
+        text = "Héllo\U000E0041 World " * 500
+        assert _sanitize_numpy(BigEndianNumpy(), text, False) == "Héllo World " * 500
+        assert dtypes == [np.dtype("<u4")]
+
+    def test_numpy_path_returns_clean_text_unchanged(self):
+        pytest.importorskip("numpy")
+        text = "Héllo Wörld 你好 👨‍👩‍👧 " * 1000
+        assert sanitize_unicode(text) is text
+
+
+class TestSanitizeUnicodeWithoutNumpy:
+    """Long strings are filtered with the regex when NumPy hasn't been imported."""
+
+    @pytest.fixture(autouse=True)
+    def no_numpy(self, monkeypatch):
+        # Earlier tests may have imported NumPy, which would take over long strings
+        monkeypatch.setitem(sys.modules, "numpy", None)
+
+    @pytest.mark.parametrize("strict", (False, True))
+    def test_long_text_without_numpy(self, strict):
+        from llm import sanitize
+
+        text = "Héllo\U000E0041 שלום\u202E\u200B 👨‍💻 " * 1000
+        assert len(text) > sanitize._NUMPY_THRESHOLD
+        pattern = sanitize._pattern(strict)
+        assert sanitize_unicode(text, strict=strict) == pattern.sub("", text)
+
+    def test_long_clean_text_without_numpy_returned_unchanged(self):
+        text = "Héllo Wörld 你好 👨‍👩‍👧 " * 1000
+        assert sanitize_unicode(text) is text
+        assert sanitize_unicode(text, strict=True) != text
+        variation = "葛\U000E0100 " * 5000
+        assert sanitize_unicode(variation) is variation
 
 
 class TestIntegrationWithModels:
@@ -286,3 +419,143 @@ class TestIntegrationWithModels:
         malicious = "System\U000E0041Prompt"
         prompt = Prompt("test", MockModel(), system=malicious)
         assert prompt.system == "SystemPrompt"
+
+    def test_sanitize_dict_returns_clean_structure_unchanged(self):
+        """sanitize_dict should not copy structures with nothing to remove."""
+        from llm.sanitize import sanitize_dict
+
+        obj = {"key": ["value", ("other", {"nested": "👨‍💻"})], "n": 1}
+        assert sanitize_dict(obj) is obj
+
+    def test_sanitize_dict_reuses_clean_subtrees(self):
+        """Only containers holding something to remove should be rebuilt."""
+        from llm.sanitize import sanitize_dict
+
+        clean = {"inner": ["a", "b"]}
+        obj = {"clean": clean, "dirty": ["x\U000E0041", "y"]}
+        result = sanitize_dict(obj)
+        assert result == {"clean": {"inner": ["a", "b"]}, "dirty": ["x", "y"]}
+        assert result is not obj
+        assert result["clean"] is clean
+
+    def test_sanitize_dict_handles_deeply_nested_clean_structure(self):
+        """Checking a deeply nested structure should not hit the recursion limit."""
+        import sys
+        from llm.sanitize import sanitize_dict
+
+        obj = inner = []
+        for _ in range(sys.getrecursionlimit() * 2):
+            inner.append([])
+            inner = inner[0]
+        inner.append("value")
+        assert sanitize_dict(obj) is obj
+
+    def test_sanitize_dict_returns_large_clean_non_ascii_structure_unchanged(self):
+        """Large clean non-ASCII payloads are checked without joining them all."""
+        import tracemalloc
+        from llm.sanitize import sanitize_dict
+
+        obj = {"items": ["你好世界" * 250 for _ in range(2000)], "short": ["é"] * 20000}
+        obj["items"].append("👨‍💻")
+        tracemalloc.start()
+        try:
+            assert sanitize_dict(obj) is obj
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # The strings alone take ~2 MB; joining them all would need ~8 MB
+        assert peak < 1_000_000
+
+        obj["items"].append("x\U000E0041")
+        assert sanitize_dict(obj)["items"][-1] == "x"
+
+    def test_sanitize_dict_handles_subclasses(self):
+        """Subclasses of str/dict/list should still be sanitized."""
+        from collections import OrderedDict
+        from llm.sanitize import sanitize_dict
+
+        class Items(list):
+            pass
+
+        obj = OrderedDict(key=Items(["value\U000E0041"]))
+        assert sanitize_dict(obj) == {"key": ["value"]}
+
+    def test_prompt_property_sanitizes_plain_string_fragments(self):
+        """Plain string fragments are sanitized; Fragment objects already are."""
+        from llm.models import Prompt
+        from llm.utils import Fragment
+
+        class MockModel:
+            supports_schema = False
+            supports_tools = False
+
+            class Options:
+                pass
+
+        prompt = Prompt(
+            "Hello\U000E0041",
+            MockModel(),
+            fragments=["plain\U000E0042", Fragment("frag\U000E0043", source="test")],
+            system=" System\U000E0044 ",
+            system_fragments=["\U000E0045 ", Fragment("sys\U000E0046", source="test")],
+        )
+        assert prompt.prompt == "plain\nfrag\nHello"
+        assert prompt.system == "sys\n\nSystem"
+
+    def test_prompt_sanitizes_on_creation(self):
+        """Prompt text and system are stored sanitized, as logged to the database."""
+        from llm.models import Prompt
+
+        class MockModel:
+            supports_schema = False
+            supports_tools = False
+
+            class Options:
+                pass
+
+        prompt = Prompt("Hello\U000E0041", MockModel(), system="System\U000E0042")
+        assert prompt._prompt == "Hello"
+        assert prompt._system == "System"
+
+    def test_sanitize_dict_handles_self_referencing_clean_structure(self):
+        """Clean structures that contain themselves should be returned unchanged."""
+        from llm.sanitize import sanitize_dict
+
+        items = ["value"]
+        items.append(items)
+        mapping = {"key": "value"}
+        mapping["self"] = mapping
+        assert sanitize_dict(items) is items
+        assert sanitize_dict(mapping) is mapping
+
+    def test_sanitize_dict_rejects_self_referencing_dirty_structure(self):
+        """Dirty self-referencing structures can't be rebuilt as a copy."""
+        from llm.sanitize import sanitize_dict
+
+        items = ["value\U000E0041"]
+        items.append(items)
+        mapping = {"key": "value\U000E0041"}
+        mapping["self"] = mapping
+        outer = []
+        outer.append(["value\U000E0041", outer])
+        for obj in (items, mapping, outer):
+            with pytest.raises(ValueError, match="contains itself"):
+                sanitize_dict(obj)
+
+    def test_sanitize_dict_reuses_clean_self_referencing_subtree(self):
+        """Clean cycles next to something to remove are reused, not rejected."""
+        from llm.sanitize import sanitize_dict
+
+        cycle = ["value"]
+        cycle.append(cycle)
+        result = sanitize_dict({"dirty": "x\U000E0041", "clean": cycle})
+        assert result["dirty"] == "x"
+        assert result["clean"] is cycle
+
+    def test_sanitize_dict_allows_shared_dirty_subtrees(self):
+        """The same container appearing twice is not a cycle."""
+        from llm.sanitize import sanitize_dict
+
+        shared = ["value\U000E0041"]
+        result = sanitize_dict({"a": shared, "b": [shared]})
+        assert result == {"a": ["value"], "b": [["value"]]}